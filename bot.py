@@ -8,14 +8,19 @@ from telegram.ext import (
     MessageHandler,
     ConversationHandler,
     ContextTypes,
+    PicklePersistence,
     filters
 )
 from enum import Enum
+from types import MappingProxyType
 from typing import Optional, Dict
-import requests
+from collections import OrderedDict
+import aiohttp
+import hashlib
 import json
+import orjson
 from typing import Dict
-import time
+import random
 import asyncio
 
 # Enable logging
@@ -44,14 +49,92 @@ class States(Enum):
     CHOOSING_PROMPT = 2    # New state for prompt choice
     REFERENCE_CHOICE = 3   # New state for yes/no on reference
     AWAITING_REFERENCE = 4 # Only if they chose to upload
-    GENERATING_IMAGE = 5
-    ITERATING_IMAGE = 6
+    ITERATING_IMAGE = 5
 
 
 
+class LeonardoError(Exception):
+    """A Leonardo API call returned a non-success status."""
+
+    def __init__(self, status: int, body: str = ""):
+        super().__init__(f"Leonardo request failed with status {status}")
+        self.status = status
+        self.body = body
+
+    @property
+    def retryable(self) -> bool:
+        """Auth/permission/validation failures won't succeed on retry."""
+        return self.status not in (400, 401, 403, 413)
+
+
+# Max number of enhanced prompts kept in the in-memory cache
+_PROMPT_CACHE_MAX = 1024
+
+# Valid numeric menu replies
+_CHOICES_12 = frozenset(("1", "2"))
+_CHOICES_123 = frozenset(("1", "2", "3"))
+
+# Static reply strings, built once at import time instead of per message
+_WELCOME = (
+    "👋 Welcome to the AI Content Generation Bot!\n\n"
+    "I'll help you create amazing meme videos for your community. "
+    "Let's follow these steps:\n\n"
+    "1️⃣ First, tell me about your memecoin character and what kind of content you want to create\n"
+    "2️⃣ We'll work together to create the perfect prompt\n"
+    "3️⃣ Generate and refine images\n"
+    "4️⃣ Create a video\n"
+    "5️⃣ Add voice-over\n\n"
+    "Please describe your character and what you'd like to create!"
+)
+_CHOICE_123_RETRY = (
+    "Please respond with 1, 2, or 3:\n"
+    "1️⃣ Use enhanced prompt\n"
+    "2️⃣ Try another enhancement\n"
+    "3️⃣ Use original prompt"
+)
+_REFERENCE_PROMPT = (
+    "Do you have a reference image you'd like to use?\n"
+    "1️⃣ Yes, I'll upload an image\n"
+    "2️⃣ No, generate from scratch\n"
+    "Please respond with 1 or 2"
+)
+_REFERENCE_RETRY = (
+    "Please respond with 1 or 2:\n"
+    "1️⃣ Yes, I'll upload an image\n"
+    "2️⃣ No, generate from scratch"
+)
+_ITERATE_RETRY = (
+    "Please respond with 1 or 2:\n"
+    "1️⃣ Try again\n"
+    "2️⃣ Modify the prompt"
+)
+_GENERATED_CAPTION = (
+    "Here's your generated image! Would you like to:\n"
+    "1️⃣ Try again\n"
+    "2️⃣ Modify the prompt\n"
+    "Please respond with 1 or 2"
+)
+_GENERATION_ERROR = (
+    "Sorry, there was an error generating the images. Would you like to:\n"
+    "1️⃣ Try again\n"
+    "2️⃣ Modify the prompt\n"
+    "Please respond with 1 or 2"
+)
+_PROCESSING = (
+    "🎨 Generating your image...\n"
+    "This might take a minute or two. Please wait..."
+)
+_PROCESSING_REFERENCE = (
+    "🎨 Processing your reference image and generating new image...\n"
+    "This might take a minute or two. Please wait..."
+)
+
+
 class ContentGenerationBot:
     def __init__(self):
-        self.user_data: Dict = {}
+        # Cache of prompt -> enhanced prompt so identical prompts skip the
+        # Leonardo round-trip (bounded, oldest entries evicted first)
+        self._prompt_cache: "OrderedDict[bytes, str]" = OrderedDict()
         
 
         
@@ -64,67 +147,134 @@ class ContentGenerationBot:
             logger.error(f"Leonardo-related environment variables found: {env_vars}")
             raise ValueError("Leonardo API key is required but not found in environment variables")
             
-        # Initialize Leonardo configuration
+        # Initialize Leonardo configuration; the headers are frozen so the
+        # hot paths pass the same mapping on every request instead of
+        # copying or re-merging dicts (the S3/Telegram calls send no
+        # Leonardo headers at all)
         self.leo_api_url = "https://cloud.leonardo.ai/api/rest/v1"
-        self.leo_headers = {
+        self.leo_headers = MappingProxyType({
             "accept": "application/json",
             "content-type": "application/json",
             "authorization": f"Bearer {self.leo_api_key}"
+        })
+
+        # Static parts of the generation payloads, built once so the hot
+        # paths only patch in the prompt / init image id
+        self._gen_payload_template = {
+            "height": 512,
+            "width": 1040,
+            "modelId": "6b645e3a-d64f-4341-a6d8-7a3690fbf042",
+            "photoReal": False,
+            "guidance_scale": 8,
+            "num_images": 1
         }
-    
+        self._gen_ref_payload_template = {
+            "height": 512,
+            "width": 1040,
+            "modelId": "e71a1c2f-4f80-4800-934f-2c68979d8cc8",
+            "photoReal": False,
+            "init_strength": 0.05,
+            "guidance_scale": 9,
+            "num_images": 1,
+            "presetStyle": "DYNAMIC"
+        }
+        self._controlnet_template = {
+            "initImageType": "UPLOADED",
+            "preprocessorId": 67,  # Style Reference
+            "strengthType": "Low"
+        }
+
+        # Bound concurrent Leonardo generations so a burst of users can't
+        # fan out into a 429 retry storm
+        self._leo_sem = asyncio.Semaphore(int(os.getenv("LEO_MAX_CONCURRENT", "8")))
+
+        # Shared aiohttp session, created lazily on the running event loop
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared aiohttp session, creating it on first use."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=100,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=60
+                )
+            )
+        return self._session
+
+    async def close_session(self, application=None) -> None:
+        """Close the shared aiohttp session (post_shutdown hook)."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
         """Start the conversation and ask for initial prompt."""
         user = update.message.from_user
         logger.info(f"User {user.first_name} started the conversation")
         
-        welcome_message = (
-            "👋 Welcome to the AI Content Generation Bot!\n\n"
-            "I'll help you create amazing meme videos for your community. "
-            "Let's follow these steps:\n\n"
-            "1️⃣ First, tell me about your memecoin character and what kind of content you want to create\n"
-            "2️⃣ We'll work together to create the perfect prompt\n"
-            "3️⃣ Generate and refine images\n"
-            "4️⃣ Create a video\n"
-            "5️⃣ Add voice-over\n\n"
-            "Please describe your character and what you'd like to create!"
-        )
-        
-        await update.message.reply_text(welcome_message)
+        await update.message.reply_text(_WELCOME)
         return States.INITIAL_PROMPT
 
     async def handle_initial_prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
         """First handler that enhances prompt with Leonardo"""
-        user_text = update.message.text
-        user_id = update.effective_user.id
-        
-        # Store original prompt
-        self.user_data[user_id] = {'original_prompt': user_text}
-        
+        return await self._enhance_prompt(update, context, update.message.text)
+
+    async def _enhance_prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                              user_text: str, force_refresh: bool = False) -> States:
+        """Enhance user_text with Leonardo and ask which prompt to use.
+
+        force_refresh skips the prompt cache so "try another enhancement"
+        actually re-rolls instead of returning the cached result.
+        """
+        # Store original prompt, dropping any state from a previous flow
+        context.user_data.clear()
+        context.user_data['original_prompt'] = user_text
+
         # Enhance prompt using Leonardo
+        cache_key = hashlib.blake2b(
+            user_text.strip().lower().encode(), digest_size=16
+        ).digest()
+
         try:
-            enhanced_prompt_response = requests.post(
-                f"{self.leo_api_url}/prompt/improve",
-                headers=self.leo_headers,
-                json={"prompt": user_text}
-            )
-            if enhanced_prompt_response.status_code != 200:
-                error_msg = enhanced_prompt_response.json().get('error', 'Unknown error')
-                logger.error(f"[DEBUG] Prompt enhancement failed: {enhanced_prompt_response.text}")
-                
-                if "too long" in error_msg.lower():
-                    await update.message.reply_text(
-                        "📝 Your prompt is too long! Please keep it under 200 characters.\n\n"
-                        f"Current length: {len(user_text)} characters\n\n"
-                        "Please try again with a shorter description."
-                    )
-                else:
-                    await update.message.reply_text(
-                        "Sorry, I had trouble enhancing your prompt. Would you like to try again?"
-                    )
-                return States.INITIAL_PROMPT
-                
-            enhanced_prompt = enhanced_prompt_response.json()['promptGeneration']['prompt']
-            self.user_data[user_id]['enhanced_prompt'] = enhanced_prompt
+            enhanced_prompt = None
+            if not force_refresh and cache_key in self._prompt_cache:
+                # Identical prompt seen before - skip the Leonardo round-trip
+                self._prompt_cache.move_to_end(cache_key)
+                enhanced_prompt = self._prompt_cache[cache_key]
+
+            if enhanced_prompt is None:
+                session = await self._get_session()
+                async with session.post(
+                    f"{self.leo_api_url}/prompt/improve",
+                    headers=self.leo_headers,
+                    json={"prompt": user_text}
+                ) as enhanced_prompt_response:
+                    status = enhanced_prompt_response.status
+                    response_body = orjson.loads(await enhanced_prompt_response.read())
+
+                if status != 200:
+                    error_msg = response_body.get('error', 'Unknown error')
+                    logger.error("Prompt enhancement failed: %s", response_body)
+
+                    if "too long" in error_msg.lower():
+                        await update.message.reply_text(
+                            "📝 Your prompt is too long! Please keep it under 200 characters.\n\n"
+                            f"Current length: {len(user_text)} characters\n\n"
+                            "Please try again with a shorter description."
+                        )
+                    else:
+                        await update.message.reply_text(
+                            "Sorry, I had trouble enhancing your prompt. Would you like to try again?"
+                        )
+                    return States.INITIAL_PROMPT
+
+                enhanced_prompt = response_body['promptGeneration']['prompt']
+                self._prompt_cache[cache_key] = enhanced_prompt
+                if len(self._prompt_cache) > _PROMPT_CACHE_MAX:
+                    self._prompt_cache.popitem(last=False)
+
+            context.user_data['enhanced_prompt'] = enhanced_prompt
             
             # Ask user if they want to use the enhanced prompt
             await update.message.reply_text(
@@ -149,383 +299,366 @@ class ContentGenerationBot:
     async def handle_prompt_choice(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
         """Handle user's choice about which prompt to use"""
         user_choice = update.message.text
-        user_id = update.effective_user.id
-        
-        if user_choice not in ["1", "2", "3"]:
-            await update.message.reply_text(
-                "Please respond with 1, 2, or 3:\n"
-                "1️⃣ Use enhanced prompt\n"
-                "2️⃣ Try another enhancement\n"
-                "3️⃣ Use original prompt"
-            )
+
+        if user_choice not in _CHOICES_123:
+            await update.message.reply_text(_CHOICE_123_RETRY)
             return States.CHOOSING_PROMPT
-            
-        if user_choice == "2":
-            
-            original_prompt = self.user_data[user_id]['original_prompt']
-            # Reuse handle_initial_prompt but with the original text
-            context.user_data['original_text'] = original_prompt  # Store temporarily
-            update.message.text = original_prompt  # Set the text to original prompt
-            return await self.handle_initial_prompt(update, context)
-            
-        # Store the chosen prompt
-        chosen_prompt = self.user_data[user_id]['enhanced_prompt'] if user_choice == "1" else self.user_data[user_id]['original_prompt']
-        self.user_data[user_id]['final_prompt'] = chosen_prompt
-        
+
+        return await self._PROMPT_DISPATCH[user_choice](self, update, context)
+
+    async def _retry_enhancement(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
+        """Re-run prompt enhancement on the original text ("2")"""
+        original_prompt = context.user_data['original_prompt']
+        return await self._enhance_prompt(update, context, original_prompt, force_refresh=True)
+
+    async def _use_enhanced_prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
+        return await self._store_final_prompt(update, context, 'enhanced_prompt')
+
+    async def _use_original_prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
+        return await self._store_final_prompt(update, context, 'original_prompt')
+
+    async def _store_final_prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                  prompt_key: str) -> States:
+        """Store the chosen prompt and ask about a reference image"""
+        context.user_data['final_prompt'] = context.user_data[prompt_key]
+
         # Ask about reference image
-        await update.message.reply_text(
-            "Do you have a reference image you'd like to use?\n"
-            "1️⃣ Yes, I'll upload an image\n"
-            "2️⃣ No, generate from scratch\n"
-            "Please respond with 1 or 2"
-        )
+        await update.message.reply_text(_REFERENCE_PROMPT)
         return States.REFERENCE_CHOICE
 
     async def handle_reference_choice(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
         """Handle whether user wants to use a reference image"""
         user_choice = update.message.text
-        user_id = update.effective_user.id
-        
-        if user_choice not in ["1", "2"]:
-            await update.message.reply_text(
-                "Please respond with 1 or 2:\n"
-                "1️⃣ Yes, I'll upload an image\n"
-                "2️⃣ No, generate from scratch"
-            )
+
+        if user_choice not in _CHOICES_12:
+            await update.message.reply_text(_REFERENCE_RETRY)
             return States.REFERENCE_CHOICE
-        
-        if user_choice == "1":
-            await update.message.reply_text("Please upload your reference image.")
-            return States.AWAITING_REFERENCE
-        else:
-            # Proceed directly to generation without reference
-            return await self.start_image_generation(update, context)
+
+        return await self._REFERENCE_DISPATCH[user_choice](self, update, context)
+
+    async def _request_reference_upload(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
+        await update.message.reply_text("Please upload your reference image.")
+        return States.AWAITING_REFERENCE
 
     async def handle_reference_image(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
         """Handle the uploaded reference image"""
-        user_id = update.effective_user.id
-        
-        if user_id not in self.user_data or 'final_prompt' not in self.user_data[user_id]:
+        if 'final_prompt' not in context.user_data:
             await update.message.reply_text(
                 "Sorry, I've lost track of your prompt. Let's start over.\n"
                 "Please provide a new prompt for your image."
             )
             return States.INITIAL_PROMPT
         
-        # Get the image file
+        # Get the image file; the file lookup and the processing message
+        # are independent Telegram calls, so overlap them
         photo = update.message.photo[-1]
-        file = await context.bot.get_file(photo.file_id)
+        file, _ = await asyncio.gather(
+            context.bot.get_file(photo.file_id),
+            update.message.reply_text(_PROCESSING_REFERENCE)
+        )
         
         # Store image info in user_data
-        self.user_data[user_id]['reference_image'] = {
+        context.user_data['reference_image'] = {
             'file_id': photo.file_id,
             'file_path': file.file_path
         }
         
-        return await self.start_image_generation(update, context)
-
-    async def handle_image_generation(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
-        """Handle the actual image generation process"""
-        user_id = update.effective_user.id
-        user_data = self.user_data.get(user_id, {})
-        
-        logger.info(f"[DEBUG] Starting image generation for user {user_id}")
-        logger.info(f"[DEBUG] User data available: {user_data}")
-        
-        try:
-            if 'reference_image' in user_data:
-                logger.info(f"[DEBUG] Using reference image: {user_data['reference_image']['file_path']}")
-                logger.info(f"[DEBUG] With refined prompt: {user_data['final_prompt']}")
-                result = await self.generate_image_with_reference(
-                    prompt=user_data['final_prompt'],
-                    image_url=user_data['reference_image']['file_path']
-                )
-            else:
-                logger.info("[DEBUG] No reference image, generating from scratch")
-                result = await self.generate_image(user_data['final_prompt'])
-            
-            if result['status'] == 'success':
-                self.user_data[user_id]['generated_images'] = [result['image_url']]
-                
-                # Send the generated image in sequence
-                await update.message.reply_photo(
-                    photo=result['image_url'],
-                    caption="Generated Image"
-                )
-                
-                # Ask for user preference
-                await update.message.reply_text(
-                    "What would you like to do?\n\n"
-                    "1️⃣ Use this image\n"
-                    "2️⃣ Generate new variations\n"
-                    "3️⃣ Modify the prompt\n\n"
-                    "Please respond with a number 1-3"
-                )
-                
-                return States.ITERATING_IMAGE
-            
-            else:
-                raise Exception(f"Generation failed: {result['error']}")
-                
-        except Exception as e:
-            logger.error(f"Error in image generation: {e}")
-            await update.message.reply_text(
-                "Sorry, there was an error generating the images. Would you like to:\n\n"
-                "1️⃣ Try again\n"
-                "2️⃣ Modify the prompt\n\n"
-                "Please respond with 1 or 2"
-            )
-            return States.GENERATING_IMAGE
+        return await self.start_image_generation(update, context, processing_sent=True)
 
     async def handle_image_iteration(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
         """Handle user's choice after seeing generated image"""
         user_choice = update.message.text
-        user_id = update.effective_user.id
-        
-        if user_choice not in ["1", "2"]:
-            await update.message.reply_text(
-                "Please respond with 1 or 2:\n"
-                "1️⃣ Try again\n"
-                "2️⃣ Modify the prompt"
-            )
+
+        if user_choice not in _CHOICES_12:
+            await update.message.reply_text(_ITERATE_RETRY)
             return States.ITERATING_IMAGE
-        
-        if user_choice == "1":
-            # Try again with same prompt
-            return await self.start_image_generation(update, context)
-        else:
-            # Clear the enhanced/final prompt but keep original for reference
-            original_prompt = self.user_data[user_id].get('original_prompt', '')
-            self.user_data[user_id] = {'original_prompt': original_prompt}
-            await update.message.reply_text(
-                "Please provide a new prompt for your image."
-            )
-            return States.INITIAL_PROMPT
 
-    async def start_image_generation(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
-        """Handle the image generation process"""
-        user_id = update.effective_user.id
-        user_data = self.user_data.get(user_id, {})
-        
-        logger.info(f"[DEBUG] Entered start_image_generation")
-        logger.info(f"[DEBUG] Starting image generation for user {user_id}")
-        logger.info(f"[DEBUG] User data available: {user_data}")
+        return await self._ITERATE_DISPATCH[user_choice](self, update, context)
+
+    async def _reset_prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> States:
+        """Clear the enhanced/final prompt but keep original for reference"""
+        original_prompt = context.user_data.get('original_prompt', '')
+        context.user_data.clear()
+        context.user_data['original_prompt'] = original_prompt
+        await update.message.reply_text(
+            "Please provide a new prompt for your image."
+        )
+        return States.INITIAL_PROMPT
+
+    async def start_image_generation(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                     processing_sent: bool = False) -> States:
+        """Handle the image generation process.
+
+        processing_sent skips the "please wait" message when the calling
+        handler already sent one (e.g. overlapped with another call).
+        """
+        user_data = context.user_data
+
+        logger.debug("Starting image generation for user %s", update.effective_user.id)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("User data available: %s", user_data)
         
         try:
             if 'reference_image' in user_data:
-                logger.info("[DEBUG] Using reference image")
+                logger.debug("Using reference image")
+                if not processing_sent:
+                    await update.message.reply_text(_PROCESSING_REFERENCE)
                 result = await self.generate_image_with_reference(
                     prompt=user_data['final_prompt'],
-                    image_url=user_data['reference_image']['file_path'],
-                    message_obj=update.message
+                    image_url=user_data['reference_image']['file_path']
                 )
             else:
-                logger.info("[DEBUG] No reference image, generating from scratch")
-                result = await self.generate_image(
-                    prompt=user_data['final_prompt'],
-                    message_obj=update.message
-                )
+                logger.debug("No reference image, generating from scratch")
+                if not processing_sent:
+                    await update.message.reply_text(_PROCESSING)
+                result = await self.generate_image(user_data['final_prompt'])
             
             if result['status'] == 'success':
                 # Send the generated image
                 await update.message.reply_photo(
                     result['image_url'],
-                    caption="Here's your generated image! Would you like to:\n"
-                            "1️⃣ Try again\n"
-                            "2️⃣ Modify the prompt\n"
-                            "Please respond with 1 or 2"
+                    caption=_GENERATED_CAPTION
                 )
                 return States.ITERATING_IMAGE
             else:
-                await update.message.reply_text(
-                    "Sorry, there was an error generating the images. Would you like to:\n"
-                    "1️⃣ Try again\n"
-                    "2️⃣ Modify the prompt\n"
-                    "Please respond with 1 or 2"
-                )
+                await update.message.reply_text(_GENERATION_ERROR)
                 return States.ITERATING_IMAGE
                 
         except Exception as e:
             logger.error(f"Error in image generation: {str(e)}")
-            await update.message.reply_text(
-                "Sorry, there was an error generating the images. Would you like to:\n"
-                "1️⃣ Try again\n"
-                "2️⃣ Modify the prompt\n"
-                "Please respond with 1 or 2"
-            )
+            await update.message.reply_text(_GENERATION_ERROR)
             return States.ITERATING_IMAGE
 
-    async def generate_image(self, prompt: str, message_obj) -> Dict:
-        """Generate image using Leonardo.ai without reference"""
-        try:
-            processing_message = await message_obj.reply_text(
-                "🎨 Generating your image...\n"
-                "This might take a minute or two. Please wait..."
-            )
-            
-            generation_url = f"{self.leo_api_url}/generations"
-            payload = {
-                "height": 512,
-                "width": 1040,
-                "modelId": "6b645e3a-d64f-4341-a6d8-7a3690fbf042",
-                "prompt": prompt,
-                "photoReal": False,
-                "guidance_scale": 8,
-                "num_images": 1
-            }
-            
-            logger.info(f"[DEBUG] Sending generation request with payload: {payload}")
-            response = requests.post(
-                generation_url,
-                headers=self.leo_headers,
-                json=payload
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"[DEBUG] Generation failed: {response.text}")
-                return {'status': 'error', 'error': f"Generation failed with status {response.status_code}"}
-            
-            generation_id = response.json()['sdGenerationJob']['generationId']
-            logger.info(f"[DEBUG] Got generation ID: {generation_id}")
-            
-            # Wait for generation with polling
-            max_attempts = 30
-            poll_interval = 2
-            
-            for attempt in range(max_attempts):
-                logger.info(f"[DEBUG] Polling attempt {attempt + 1}/{max_attempts}")
-                
-                results_url = f"{self.leo_api_url}/generations/{generation_id}"
-                results_response = requests.get(results_url, headers=self.leo_headers)
-                
-                if results_response.status_code == 200:
-                    generation_data = results_response.json()
-                    logger.info(f"[DEBUG] Generation response: {generation_data}")
-                    
+    async def _await_generation(self, generation_id: str, timeout: float = 180,
+                                max_consecutive_errors: int = 5) -> Dict:
+        """Poll Leonardo for a generation result, backing off exponentially.
+
+        Starts at 1.5s between polls and grows the delay up to 8s (with a
+        little jitter so concurrent generations don't poll in lockstep).
+        Gives up after the wall-clock timeout, or earlier if polling fails
+        max_consecutive_errors times in a row with no successful response
+        in between.
+        """
+        session = await self._get_session()
+        results_url = f"{self.leo_api_url}/generations/{generation_id}"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = 1.5
+        consecutive_errors = 0
+
+        while loop.time() < deadline:
+            await asyncio.sleep(delay + random.uniform(0, 0.3 * delay))
+            retry_after = 0.0
+
+            async with session.get(results_url, headers=self.leo_headers) as results_response:
+                if results_response.status == 200:
+                    consecutive_errors = 0
+                    generation_data = orjson.loads(await results_response.read())
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Generation response: %s", generation_data)
+                    status = generation_data.get('generations_by_pk', {}).get('status')
+
                     # Check if generation is complete
-                    if generation_data.get('generations_by_pk', {}).get('status') == 'COMPLETE':
+                    if status == 'COMPLETE':
                         generated_images = generation_data.get('generations_by_pk', {}).get('generated_images', [])
                         if generated_images:
-                            logger.info(f"[DEBUG] Successfully got {len(generated_images)} generated images")
+                            logger.debug("Successfully got %d generated images", len(generated_images))
                             return {
                                 'status': 'success',
                                 'image_url': generated_images[0]['url']
                             }
-            
-                await asyncio.sleep(poll_interval)
-            
+
+                    # Terminal failure - no point polling until the deadline
+                    if status in ('FAILED', 'CANCELLED', 'DELETED'):
+                        logger.error("Generation %s ended with status %s", generation_id, status)
+                        return {
+                            'status': 'error',
+                            'error': f"Leonardo returned {status}"
+                        }
+
+                elif 400 <= results_response.status < 500 and results_response.status != 429:
+                    # Client errors won't fix themselves on retry
+                    logger.error("Poll failed with status %s", results_response.status)
+                    return {
+                        'status': 'error',
+                        'error': f"Polling failed with status {results_response.status}"
+                    }
+
+                else:
+                    # Rate limits and server errors may be transient, but
+                    # stop burning quota once the error budget is spent
+                    consecutive_errors += 1
+                    logger.warning(
+                        "Poll failed with status %s (%d consecutive errors)",
+                        results_response.status, consecutive_errors
+                    )
+                    if consecutive_errors >= max_consecutive_errors:
+                        return {
+                            'status': 'error',
+                            'error': f"Polling failed {consecutive_errors} times in a row"
+                        }
+                    if results_response.status == 429:
+                        try:
+                            retry_after = float(results_response.headers.get('Retry-After', ''))
+                        except ValueError:
+                            retry_after = 0.0
+
+            # Back off, but never sleep less than a server-requested Retry-After
+            delay = max(min(delay * 1.6, 8.0), retry_after)
+
+        return {
+            'status': 'error',
+            'error': 'Generation timed out or failed to complete'
+        }
+
+    async def generate_image(self, prompt: str) -> Dict:
+        """Generate image using Leonardo.ai without reference"""
+        try:
+            generation_url = f"{self.leo_api_url}/generations"
+            payload = {**self._gen_payload_template, "prompt": prompt}
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Sending generation request with payload: %s", payload)
+            session = await self._get_session()
+
+            # Hold a generation slot for the POST and the polling that follows
+            async with self._leo_sem:
+                async with session.post(
+                    generation_url,
+                    headers=self.leo_headers,
+                    data=orjson.dumps(payload)
+                ) as response:
+                    if response.status != 200:
+                        raise LeonardoError(response.status, await response.text())
+                    response_body = orjson.loads(await response.read())
+
+                generation_id = response_body['sdGenerationJob']['generationId']
+                logger.debug("Got generation ID: %s", generation_id)
+
+                # Wait for generation with polling
+                return await self._await_generation(generation_id)
+
+        except LeonardoError as e:
+            if e.status in (401, 403):
+                logger.error("Leonardo auth failure (%s), not retrying: %s", e.status, e.body)
+            else:
+                logger.error("Leonardo error %s: %s", e.status, e.body)
             return {
                 'status': 'error',
-                'error': 'Generation timed out or failed to complete'
+                'error': str(e),
+                'retryable': e.retryable
             }
-            
         except Exception as e:
-            logger.error(f"[DEBUG] Error in generate_image: {str(e)}")
+            logger.error("Error in generate_image: %s", e)
             return {
                 'status': 'error',
                 'error': str(e)
             }
 
 
-    async def generate_image_with_reference(self, prompt: str, image_url: str, message_obj) -> Dict:
+    async def generate_image_with_reference(self, prompt: str, image_url: str) -> Dict:
         """Generate image using Leonardo.ai with reference"""
         try:
-            # Send processing message
-            processing_message = await message_obj.reply_text(
-                "🎨 Processing your reference image and generating new image...\n"
-                "This might take a minute or two. Please wait..."
-            )
-            
             # Step 1: Get presigned URL and upload image
             upload_url = f"{self.leo_api_url}/init-image"
             payload = {"extension": "jpg"}
             
-            logger.info("[DEBUG] Getting presigned URL for image upload")
-            upload_response = requests.post(
-                upload_url,
-                headers=self.leo_headers,
-                json=payload
+            logger.debug("Getting presigned URL for image upload")
+            session = await self._get_session()
+
+            # The presigned-URL request and the Telegram download are
+            # independent, so fire them in parallel. return_exceptions so
+            # that if one fails, the other's response can still be closed
+            # instead of leaking its pooled connection
+            responses = await asyncio.gather(
+                session.post(upload_url, headers=self.leo_headers, json=payload),
+                session.get(image_url),
+                return_exceptions=True
             )
-            
-            if upload_response.status_code != 200:
-                logger.error(f"[DEBUG] Failed to get presigned URL: {upload_response.text}")
-                raise Exception("Failed to get presigned URL from Leonardo")
-            
-            # Parse upload data exactly as in their docs
-            fields = json.loads(upload_response.json()['uploadInitImage']['fields'])
-            url = upload_response.json()['uploadInitImage']['url']
-            image_id = upload_response.json()['uploadInitImage']['id']
-            
-            logger.info(f"[DEBUG] Got image ID: {image_id}")
-            
-            # Get image from Telegram
-            image_response = requests.get(image_url)
-            if image_response.status_code != 200:
-                raise Exception("Failed to download image from Telegram")
-            
-            
-            files = {'file': ('image.jpg', image_response.content, 'image/jpeg')}
-            s3_response = requests.post(url, data=fields, files=files)  
-            
-            if s3_response.status_code != 204:
-                logger.error(f"[DEBUG] S3 upload failed with status {s3_response.status_code}")
-                raise Exception("Failed to upload to S3")
+            failures = [r for r in responses if isinstance(r, BaseException)]
+            if failures:
+                for resp in responses:
+                    if not isinstance(resp, BaseException):
+                        resp.close()
+                raise failures[0]
+            upload_response, image_response = responses
+
+            try:
+                if upload_response.status != 200:
+                    raise LeonardoError(upload_response.status, await upload_response.text())
+                upload_data = orjson.loads(await upload_response.read())
+
+                # Parse upload data exactly as in their docs
+                fields = json.loads(upload_data['uploadInitImage']['fields'])
+                url = upload_data['uploadInitImage']['url']
+                image_id = upload_data['uploadInitImage']['id']
+
+                logger.debug("Got image ID: %s", image_id)
+
+                if image_response.status != 200:
+                    raise Exception("Failed to download image from Telegram")
+
+                # S3's presigned POST rejects chunked transfer encoding, so
+                # the body has to be buffered to give the multipart upload a
+                # computable Content-Length
+                image_bytes = await image_response.read()
+
+                form = aiohttp.FormData()
+                for field_name, field_value in fields.items():
+                    form.add_field(field_name, field_value)
+                form.add_field(
+                    'file',
+                    image_bytes,
+                    filename='image.jpg',
+                    content_type='image/jpeg'
+                )
+
+                async with session.post(url, data=form) as s3_response:
+                    if s3_response.status != 204:
+                        logger.error("S3 upload failed with status %s", s3_response.status)
+                        raise Exception("Failed to upload to S3")
+            finally:
+                upload_response.release()
+                image_response.close()
             
             generation_url = f"{self.leo_api_url}/generations"
             payload = {
-                "height": 512,
-                "width": 1040,
-                "modelId": "e71a1c2f-4f80-4800-934f-2c68979d8cc8", 
+                **self._gen_ref_payload_template,
                 "prompt": prompt,
-                "photoReal": False,
                 "init_image_id": image_id,
-                "init_strength": 0.05,  
                 "controlnets": [
-                    {
-                        "initImageId": image_id,
-                        "initImageType": "UPLOADED",
-                        "preprocessorId": 67,  # Style Reference
-                        "strengthType": "Low"  
-                    }
-                ],
-                "guidance_scale": 9,  
-                "num_images": 1,
-                "presetStyle": "DYNAMIC"  
+                    {**self._controlnet_template, "initImageId": image_id}
+                ]
             }
-            
-            logger.info(f"[DEBUG] Sending generation request with payload: {payload}")
-            response = requests.post(generation_url, json=payload, headers=self.leo_headers)
-            
-            if response.status_code != 200:
-                logger.error(f"[DEBUG] Generation failed: {response.text}")
-                raise Exception(f"Generation failed with status {response.status_code}")
-                
-            generation_id = response.json()['sdGenerationJob']['generationId']
-            logger.info(f"[DEBUG] Got generation ID: {generation_id}")
-            
-            
-            time.sleep(20)  
-            
-            # Get the results
-            results_url = f"{self.leo_api_url}/generations/{generation_id}"
-            results_response = requests.get(results_url, headers=self.leo_headers)
-            
-            if results_response.status_code == 200:
-                generated_images = results_response.json().get('generations_by_pk', {}).get('generated_images', [])
-                if generated_images:
-                    logger.info("[DEBUG] Successfully got generated image")
-                    return {
-                        'status': 'success',
-                        'image_url': generated_images[0]['url']
-                    }
-            
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Sending generation request with payload: %s", payload)
+
+            # Hold a generation slot for the POST and the polling that follows
+            async with self._leo_sem:
+                async with session.post(generation_url, data=orjson.dumps(payload), headers=self.leo_headers) as response:
+                    if response.status != 200:
+                        raise LeonardoError(response.status, await response.text())
+                    response_body = orjson.loads(await response.read())
+
+                generation_id = response_body['sdGenerationJob']['generationId']
+                logger.debug("Got generation ID: %s", generation_id)
+
+                # Wait for generation with polling
+                return await self._await_generation(generation_id)
+
+        except LeonardoError as e:
+            if e.status in (401, 403):
+                logger.error("Leonardo auth failure (%s), not retrying: %s", e.status, e.body)
+            else:
+                logger.error("Leonardo error %s: %s", e.status, e.body)
             return {
                 'status': 'error',
-                'error': 'Failed to get generated image'
+                'error': str(e),
+                'retryable': e.retryable
             }
-            
         except Exception as e:
-            logger.error(f"[DEBUG] Error in generate_image_with_reference: {str(e)}")
+            logger.error("Error in generate_image_with_reference: %s", e)
             return {
                 'status': 'error',
                 'error': str(e)
@@ -539,6 +672,22 @@ class ContentGenerationBot:
         )
         return ConversationHandler.END
 
+    # Dispatch tables for the numeric menus (choices are validated against
+    # the frozensets at module top before lookup)
+    _PROMPT_DISPATCH = {
+        "1": _use_enhanced_prompt,
+        "2": _retry_enhancement,
+        "3": _use_original_prompt
+    }
+    _REFERENCE_DISPATCH = {
+        "1": _request_reference_upload,
+        "2": start_image_generation
+    }
+    _ITERATE_DISPATCH = {
+        "1": start_image_generation,
+        "2": _reset_prompt
+    }
+
 def main():
     """Run the bot."""
     # Create the bot instance
@@ -550,8 +699,19 @@ def main():
         logger.error("No TELEGRAM_TOKEN found in environment variables")
         return
 
-    # Create the Application
-    application = ApplicationBuilder().token(token).build()
+    # Create the Application; conversation and user state survive restarts
+    # via pickle-backed persistence. concurrent_updates lets handlers for
+    # different users run in parallel - without it one user's generation
+    # would block everyone else's messages
+    persistence = PicklePersistence(filepath="bot_state.pkl")
+    application = (
+        ApplicationBuilder()
+        .token(token)
+        .persistence(persistence)
+        .concurrent_updates(True)
+        .post_shutdown(bot.close_session)
+        .build()
+    )
 
     # Create conversation handler
     conv_handler = ConversationHandler(
@@ -569,22 +729,36 @@ def main():
             States.AWAITING_REFERENCE: [
                 MessageHandler(filters.PHOTO, bot.handle_reference_image)
             ],
-            States.GENERATING_IMAGE: [
-                MessageHandler(filters.ALL & ~filters.COMMAND, bot.start_image_generation)
-            ],
             States.ITERATING_IMAGE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_image_iteration)
             ]
         },
-        fallbacks=[CommandHandler('cancel', bot.cancel)]
+        fallbacks=[CommandHandler('cancel', bot.cancel)],
+        name="content_generation",
+        persistent=True
     )
 
     # Add conversation handler to the application
     application.add_handler(conv_handler)
 
-    # Start the Bot
-    logger.info("Starting bot...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Start the Bot - webhook mode when a public URL is configured (Telegram
+    # pushes updates to us, no getUpdates long-poll latency), otherwise fall
+    # back to long polling for local development
+    public_url = os.getenv("PUBLIC_URL")
+    if public_url:
+        port = int(os.getenv("PORT", "8443"))
+        logger.info(f"Starting bot with webhook on port {port}...")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=port,
+            url_path=token,
+            webhook_url=f"{public_url.rstrip('/')}/{token}",
+            secret_token=os.getenv("TG_SECRET"),
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        logger.info("Starting bot with long polling (set PUBLIC_URL to use a webhook)...")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()